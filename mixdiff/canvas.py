@@ -1,8 +1,8 @@
 from copy import deepcopy
-from dataclasses import asdict, dataclass
+from dataclasses import asdict, dataclass, field
 from enum import Enum
+from math import pi, sqrt
 import numpy as np
-from numpy import pi, exp, sqrt
 import re
 import torch
 from torchvision.transforms.functional import resize
@@ -59,6 +59,8 @@ class CanvasRegion:
         self.latent_row_end = self.row_end // 8
         self.latent_col_init = self.col_init // 8
         self.latent_col_end = self.col_end // 8
+        # Slice selecting this region in a latents tensor
+        self.latent_slice = (slice(None), slice(None), slice(self.latent_row_init, self.latent_row_end), slice(self.latent_col_init, self.latent_col_end))
 
     @property
     def width(self):
@@ -146,7 +148,7 @@ class Image2ImageRegion(DiffusionRegion):
             # Note here we use mean instead of sample, to avoid moving also generator to CPU, which is troublesome
             self.reference_latents = encoder.cpu().encode(self.reference_image).latent_dist.mean.to(device)
         else:
-            self.reference_latents = encoder.encode(self.reference_image.to(device)).latent_dist.sample(generator=generator)
+            self.reference_latents = encoder.encode(self.reference_image.to(device, dtype=encoder.dtype)).latent_dist.sample(generator=generator)
         self.reference_latents = 0.18215 * self.reference_latents
 
     @property
@@ -165,24 +167,33 @@ class Image2ImageRegion(DiffusionRegion):
 
 @dataclass
 class MaskWeightsBuilder:
-    """Auxiliary class to compute a tensor of weights for a given diffusion region"""
-    latent_space_dim: int  # Size of the U-net latent space
-    nbatch: int = 1  # Batch size in the U-net
+    """Auxiliary class to compute a tensor of weights for a given diffusion region
+
+    Weights are returned with shape (1, 1, height, width), to be broadcasted over the batch and latent channels.
+    """
+    device: Union[str, torch.device] = "cpu"  # Device where the weight tensors are placed
+    _cache: dict = field(default_factory=dict, init=False, repr=False)  # Weight tensors already built, by mask type, shape and weight
 
     def compute_mask_weights(self, region: DiffusionRegion) -> torch.tensor:
-        """Computes a tensor of weights for a given diffusion region"""
+        """Computes a tensor of weights for a given diffusion region, placed on the builder device
+
+        Regions sharing mask type, latent shape and mask weight get the same tensor, so it must be treated as read-only.
+        """
         MASK_BUILDERS = {
             MaskModes.CONSTANT.value: self._constant_weights,
             MaskModes.GAUSSIAN.value: self._gaussian_weights,
             MaskModes.QUARTIC.value: self._quartic_weights,
         }
-        return MASK_BUILDERS[region.mask_type](region)
+        key = (region.mask_type, region.latent_row_end - region.latent_row_init, region.latent_col_end - region.latent_col_init, region.mask_weight)
+        if key not in self._cache:
+            self._cache[key] = MASK_BUILDERS[region.mask_type](region)
+        return self._cache[key]
 
     def _constant_weights(self, region: DiffusionRegion) -> torch.tensor:
         """Computes a tensor of constant for a given diffusion region"""
         latent_width = region.latent_col_end - region.latent_col_init
         latent_height = region.latent_row_end - region.latent_row_init
-        return torch.ones(self.nbatch, self.latent_space_dim, latent_height, latent_width) * region.mask_weight
+        return torch.full((1, 1, latent_height, latent_width), region.mask_weight, dtype=torch.float32, device=self.device)
 
     def _gaussian_weights(self, region: DiffusionRegion) -> torch.tensor:
         """Generates a gaussian mask of weights for tile contributions"""
@@ -190,29 +201,88 @@ class MaskWeightsBuilder:
         latent_height = region.latent_row_end - region.latent_row_init
 
         var = 0.01
+        norm = sqrt(2*pi*var)
+        x = torch.arange(latent_width, dtype=torch.float32, device=self.device)
         midpoint = (latent_width - 1) / 2  # -1 because index goes from 0 to latent_width - 1
-        x_probs = [exp(-(x-midpoint)*(x-midpoint)/(latent_width*latent_width)/(2*var)) / sqrt(2*pi*var) for x in range(latent_width)]
-        midpoint = (latent_height -1) / 2
-        y_probs = [exp(-(y-midpoint)*(y-midpoint)/(latent_height*latent_height)/(2*var)) / sqrt(2*pi*var) for y in range(latent_height)]
-        
-        weights = np.outer(y_probs, x_probs) * region.mask_weight
-        return torch.tile(torch.tensor(weights), (self.nbatch, self.latent_space_dim, 1, 1))
+        x_probs = torch.exp(-torch.square(x - midpoint) * (1 / (latent_width*latent_width*2*var))) / norm
+        y = torch.arange(latent_height, dtype=torch.float32, device=self.device)
+        midpoint = (latent_height - 1) / 2
+        y_probs = torch.exp(-torch.square(y - midpoint) * (1 / (latent_height*latent_height*2*var))) / norm
+
+        weights = torch.outer(y_probs, x_probs).mul_(region.mask_weight)
+        return weights.unsqueeze(0).unsqueeze(0)
 
     def _quartic_weights(self, region: DiffusionRegion) -> torch.tensor:
         """Generates a quartic mask of weights for tile contributions
         
         The quartic kernel has bounded support over the diffusion region, and a smooth decay to the region limits.
         """
-        quartic_constant = 15. / 16.        
+        quartic_constant = 15. / 16.
+        latent_width = region.latent_col_end - region.latent_col_init
+        latent_height = region.latent_row_end - region.latent_row_init
 
-        support = (np.array(range(region.latent_col_init, region.latent_col_end)) - region.latent_col_init) / (region.latent_col_end - region.latent_col_init - 1) * 1.99 - (1.99 / 2.)
-        x_probs = quartic_constant * np.square(1 - np.square(support))
-        support = (np.array(range(region.latent_row_init, region.latent_row_end)) - region.latent_row_init) / (region.latent_row_end - region.latent_row_init - 1) * 1.99 - (1.99 / 2.)
-        y_probs = quartic_constant * np.square(1 - np.square(support))
+        support = torch.linspace(-0.995, 0.995, latent_width, device=self.device)
+        x_probs = quartic_constant * (1 - support * support) ** 2
+        support = torch.linspace(-0.995, 0.995, latent_height, device=self.device)
+        y_probs = quartic_constant * (1 - support * support) ** 2
+
+        weights = torch.outer(y_probs, x_probs).mul_(region.mask_weight)
+        return weights.unsqueeze(0).unsqueeze(0)
+
+
+def _merge_noise_predictions(noise_preds_padded: torch.Tensor, masks_padded: torch.Tensor, inv_contributors: torch.Tensor) -> torch.Tensor:
+    """Merges the noise predictions of several regions into a single canvas of noise predictions
+
+    Noise predictions and masks are stacked along their first dimension, one canvas-sized entry per region, with zeros outside the region.
+    Noise predictions have shape (regions, batch, channels, height, width) and masks (regions, height, width).
+    inv_contributors is the inverse of the masks sum over all regions, shape (height, width), and zero where no region contributes.
+    It is constant during a generation, so it is precomputed by the caller (see _inverse_contributors).
+    Overlapping areas are averaged using the mask weights.
+    """
+    # Weighting and summing over regions are done as a single contraction
+    return torch.einsum("nbchw,nhw->bchw", noise_preds_padded, masks_padded) * inv_contributors
+
+
+def _inverse_contributors(masks_padded: torch.Tensor) -> torch.Tensor:
+    """Computes the normalizer that averages the contributions of regions, given their canvas-sized masks
+
+    Positions not covered by any DiffusionRegion have no contributors: they get a zero normalizer instead of a division by zero.
+    """
+    contributors = masks_padded.sum(0)
+    return torch.where(contributors > 0, 1 / contributors, 0.)
+
+
+def _group_regions_by_shape(regions: List[DiffusionRegion]) -> List[List[int]]:
+    """Groups the indices of a list of regions by their shape in latent space"""
+    groups = {}
+    for idx, region in enumerate(regions):
+        shape = (region.latent_row_end - region.latent_row_init, region.latent_col_end - region.latent_col_init)
+        groups.setdefault(shape, []).append(idx)
+    return list(groups.values())
+
+
+def _batch_regions(regions: List[DiffusionRegion], regions_batch_size: Optional[int] = None, pad: bool = False) -> List[Tuple[List[int], List[int]]]:
+    """Splits a list of regions into batches of regions with the same shape in latent space
+
+    Each batch holds at most regions_batch_size regions, or all regions of a shape if regions_batch_size is None.
+    Returns a list of tuples with:
+        - Indices of the regions whose predictions are taken from the batch
+        - Indices of the regions to feed into the batch
+
+    If pad is True, the last batch of a shape spanning several batches is padded repeating its last region, so that all batches
+    of that shape have the same size. Padded entries only appear in the second list: their predictions are meant to be discarded.
+    """
+    batches = []
+    for shape_indices in _group_regions_by_shape(regions):
+        shape_batch_size = len(shape_indices) if regions_batch_size is None else regions_batch_size
+        for batch_start in range(0, len(shape_indices), shape_batch_size):
+            batch_indices = shape_indices[batch_start:batch_start+shape_batch_size]
+            batch_inputs = batch_indices
+            if pad and len(shape_indices) > shape_batch_size:
+                batch_inputs = batch_indices + [batch_indices[-1]] * (shape_batch_size - len(batch_indices))
+            batches.append((batch_indices, batch_inputs))
+    return batches
 
-        weights = np.outer(y_probs, x_probs) * region.mask_weight
-        return torch.tile(torch.tensor(weights), (self.nbatch, self.latent_space_dim, 1, 1))
-        
 
 class StableDiffusionCanvasPipeline(DiffusionPipeline):
     """Stable Diffusion pipeline that mixes several diffusers in the same canvas"""
@@ -225,6 +295,7 @@ class StableDiffusionCanvasPipeline(DiffusionPipeline):
         scheduler: Union[DDIMScheduler, LMSDiscreteScheduler, PNDMScheduler],
         safety_checker: StableDiffusionSafetyChecker,
         feature_extractor: CLIPFeatureExtractor,
+        compile: bool = False,
     ):
         super().__init__()
         self.register_modules(
@@ -236,22 +307,34 @@ class StableDiffusionCanvasPipeline(DiffusionPipeline):
             safety_checker=safety_checker,
             feature_extractor=feature_extractor,
         )
+        self.register_to_config(compile=compile)
+        # Channels last memory layout speeds up the U-net convolutions
+        self.unet.to(memory_format=torch.channels_last)
+        # Compiled versions of the U-net and the noise merge step, if requested. Actual compilation takes place in the first call
+        # The merge step does not use CUDA graphs: its output is kept by multistep schedulers such as PNDM, and a graph replay would overwrite it
+        if compile:
+            self._unet_forward = torch.compile(self.unet, mode="reduce-overhead", fullgraph=True)
+            self._merge_noise_predictions = torch.compile(_merge_noise_predictions)
+        else:
+            self._unet_forward = self.unet
+            self._merge_noise_predictions = _merge_noise_predictions
 
     def decode_latents(self, latents, cpu_vae=False):
         """Decodes a given array of latents into pixel space"""
         # scale and decode the image latents with vae
         if cpu_vae:
-            lat = deepcopy(latents).cpu()
-            vae = deepcopy(self.vae).cpu()
+            # Half precision is not supported by many CPU operations, so the CPU decoder always runs in float32
+            lat = deepcopy(latents).cpu().float()
+            vae = deepcopy(self.vae).cpu().float()
         else:
-            lat = latents
+            lat = latents.to(self.vae.dtype)
             vae = self.vae
 
         lat = 1 / 0.18215 * lat
         image = vae.decode(lat).sample
 
         image = (image / 2 + 0.5).clamp(0, 1)
-        image = image.cpu().permute(0, 2, 3, 1).numpy()
+        image = image.cpu().permute(0, 2, 3, 1).float().numpy()
 
         return self.numpy_to_pil(image)
 
@@ -277,10 +360,13 @@ class StableDiffusionCanvasPipeline(DiffusionPipeline):
         seed: Optional[int] = 12345,
         reroll_regions: Optional[List[RerollRegion]] = None,
         cpu_vae: Optional[bool] = False,
-        decode_steps: Optional[bool] = False
+        decode_steps: Optional[bool] = False,
+        regions_batch_size: Optional[int] = 1
     ):
         if reroll_regions is None:
             reroll_regions = []
+        if regions_batch_size is not None and regions_batch_size < 1:
+            raise ValueError(f"regions_batch_size must be a positive integer or None, found {regions_batch_size}")
         batch_size = 1
 
         if decode_steps:
@@ -307,82 +393,104 @@ class StableDiffusionCanvasPipeline(DiffusionPipeline):
         for region in reroll_regions:
             if region.reroll_mode == RerollModes.RESET.value:
                 region_shape = (latents_shape[0], latents_shape[1], region.latent_row_end - region.latent_row_init, region.latent_col_end - region.latent_col_init)
-                init_noise[:, :, region.latent_row_init:region.latent_row_end, region.latent_col_init:region.latent_col_end] = torch.randn(region_shape, generator=region.get_region_generator(self.device), device=self.device)
+                init_noise[region.latent_slice] = torch.randn(region_shape, generator=region.get_region_generator(self.device), device=self.device)
 
         # Apply epsilon noise to regions: first diffusion regions, then reroll regions
         all_eps_rerolls = regions + [r for r in reroll_regions if r.reroll_mode == RerollModes.EPSILON.value]
         for region in all_eps_rerolls:
             if region.noise_eps > 0:
-                region_noise = init_noise[:, :, region.latent_row_init:region.latent_row_end, region.latent_col_init:region.latent_col_end]
+                region_noise = init_noise[region.latent_slice]
                 eps_noise = torch.randn(region_noise.shape, generator=region.get_region_generator(self.device), device=self.device) * region.noise_eps
-                init_noise[:, :, region.latent_row_init:region.latent_row_end, region.latent_col_init:region.latent_col_end] += eps_noise
+                init_noise[region.latent_slice] += eps_noise
 
+        # Noise is generated in float32 for all data types, so that seeds produce the same images, then moved to the U-net data type
+        init_noise = init_noise.to(self.unet.dtype)
         # scale the initial noise by the standard deviation required by the scheduler
         latents = init_noise * self.scheduler.init_noise_sigma
+        latents = latents.to(memory_format=torch.channels_last)
 
         # Get unconditional embeddings for classifier free guidance in text2image regions
-        for region in text2image_regions:
-            max_length = region.tokenized_prompt.input_ids.shape[-1]
+        # All prompts are padded to the tokenizer max length, so the same unconditional embeddings are valid for every region
+        if text2image_regions:
             uncond_input = self.tokenizer(
-                [""] * batch_size, padding="max_length", max_length=max_length, return_tensors="pt"
+                [""] * batch_size, padding="max_length", max_length=self.tokenizer.model_max_length, return_tensors="pt"
             )
             uncond_embeddings = self.text_encoder(uncond_input.input_ids.to(self.device))[0]
-
-            # For classifier free guidance, we need to do two forward passes.
-            # Here we concatenate the unconditional and text embeddings into a single batch
-            # to avoid doing two forward passes
-            region.encoded_prompt = torch.cat([uncond_embeddings, region.encoded_prompt])
+            for region in text2image_regions:
+                # For classifier free guidance, we need to do two forward passes.
+                # Here we concatenate the unconditional and text embeddings into a single batch
+                # to avoid doing two forward passes
+                region.encoded_prompt = torch.cat([uncond_embeddings, region.encoded_prompt]).to(self.unet.dtype)
 
         # Prepare image latents
         for region in image2image_regions:
             region.encode_reference_image(self.vae, device=self.device, generator=generator)
+            region.reference_latents = region.reference_latents.to(dtype=self.unet.dtype, memory_format=torch.channels_last)
 
         # Prepare mask of weights for each region
-        mask_builder = MaskWeightsBuilder(latent_space_dim=self.unet.config.in_channels, nbatch=batch_size)
-        mask_weights = [mask_builder.compute_mask_weights(region).to(self.device) for region in text2image_regions]
+        # Masks and the merge of noise predictions always use float32: in half precision mask weights near region corners underflow to zero
+        mask_builder = MaskWeightsBuilder(device=self.device)
+        mask_weights = [mask_builder.compute_mask_weights(region) for region in text2image_regions]
+        # Place each mask in a canvas-sized tensor, so that all regions can be merged at once
+        masks_padded = torch.zeros((len(text2image_regions), *latents.shape[-2:]), device=self.device, dtype=torch.float32)
+        for region_masks_padded, region, mask_weights_region in zip(masks_padded, text2image_regions, mask_weights):
+            region_masks_padded[region.latent_slice[2:]] = mask_weights_region[0, 0]
+        inv_contributors = _inverse_contributors(masks_padded)
+        # Buffer for the noise predictions of each region, also canvas-sized. Every step overwrites the same region areas, so values outside them stay zero
+        noise_preds_padded = torch.zeros((len(text2image_regions), *latents.shape), device=self.device, dtype=torch.float32)
+
+        # Batch text2image regions with the same shape, to run them through the U-net together
+        # With a compiled U-net, incomplete batches are padded so that they replay the same CUDA graph instead of capturing a new one
+        region_batches = []
+        for batch_indices, batch_inputs in _batch_regions(text2image_regions, regions_batch_size, pad=self.config.compile):
+            batch_regions = [text2image_regions[idx] for idx in batch_inputs]
+            # Unconditional embeddings of all regions go first, then text embeddings, matching the layout of the latents batch
+            batch_prompts = torch.cat(
+                [region.encoded_prompt[:batch_size] for region in batch_regions] + [region.encoded_prompt[batch_size:] for region in batch_regions]
+            )
+            batch_guidance = torch.tensor([region.guidance_scale for region in batch_regions], device=self.device, dtype=latents.dtype)
+            batch_guidance = batch_guidance.repeat_interleave(batch_size).view(-1, 1, 1, 1)
+            region_batches.append((batch_indices, batch_inputs, batch_prompts, batch_guidance))
+
+        # Find the last timestep where each Image2Image region imposes its latents (given by its strength)
+        influence_steps = [self.get_latest_timestep_img2img(num_inference_steps, region.strength) for region in image2image_regions]
 
         # Diffusion timesteps
         for i, t in tqdm(enumerate(self.scheduler.timesteps)):
             # Diffuse each region            
-            noise_preds_regions = []
+            noise_preds_regions = [None] * len(text2image_regions)
 
             # text2image regions
-            for region in text2image_regions:
-                region_latents = latents[:, :, region.latent_row_init:region.latent_row_end, region.latent_col_init:region.latent_col_end]
+            for batch_indices, batch_inputs, batch_prompts, batch_guidance in region_batches:
+                batch_latents = torch.cat([latents[text2image_regions[idx].latent_slice] for idx in batch_inputs])
                 # expand the latents if we are doing classifier free guidance
-                latent_model_input = torch.cat([region_latents] * 2)
+                latent_model_input = torch.cat([batch_latents] * 2).to(memory_format=torch.channels_last)
                 # scale model input following scheduler rules
                 latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
                 # predict the noise residual
-                noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=region.encoded_prompt)["sample"]
+                noise_pred = self._unet_forward(latent_model_input, t, encoder_hidden_states=batch_prompts)["sample"]
                 # perform guidance
                 noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                noise_pred_region = noise_pred_uncond + region.guidance_scale * (noise_pred_text - noise_pred_uncond)
-                noise_preds_regions.append(noise_pred_region)
-                
+                noise_pred_batch = noise_pred_uncond + batch_guidance * (noise_pred_text - noise_pred_uncond)
+                for idx, noise_pred_region in zip(batch_indices, noise_pred_batch.split(batch_size)):
+                    noise_preds_regions[idx] = noise_pred_region
+
             # Merge noise predictions for all tiles
-            noise_pred = torch.zeros(latents.shape, device=self.device)
-            contributors = torch.zeros(latents.shape, device=self.device)
-            # Add each tile contribution to overall latents
-            for region, noise_pred_region, mask_weights_region in zip(text2image_regions, noise_preds_regions, mask_weights):
-                noise_pred[:, :, region.latent_row_init:region.latent_row_end, region.latent_col_init:region.latent_col_end] += noise_pred_region * mask_weights_region
-                contributors[:, :, region.latent_row_init:region.latent_row_end, region.latent_col_init:region.latent_col_end] += mask_weights_region
-            # Average overlapping areas with more than 1 contributor
-            noise_pred /= contributors
-            noise_pred = torch.nan_to_num(noise_pred)  # Replace NaNs by zeros: NaN can appear if a position is not covered by any DiffusionRegion
+            for region_noise_preds_padded, region, noise_pred_region in zip(noise_preds_padded, text2image_regions, noise_preds_regions):
+                region_noise_preds_padded[region.latent_slice] = noise_pred_region
+            noise_pred = self._merge_noise_predictions(noise_preds_padded, masks_padded, inv_contributors).to(latents.dtype)
 
             # compute the previous noisy sample x_t -> x_t-1
             latents = self.scheduler.step(noise_pred, t, latents).prev_sample
 
             # Image2Image regions: override latents generated by the scheduler
-            for region in image2image_regions:
-                influence_step = self.get_latest_timestep_img2img(num_inference_steps, region.strength)
+            for region, influence_step in zip(image2image_regions, influence_steps):
                 # Only override in the timesteps before the last influence step of the image (given by its strength)
                 if t > influence_step:
                     timestep = t.repeat(batch_size)
-                    region_init_noise = init_noise[:, :, region.latent_row_init:region.latent_row_end, region.latent_col_init:region.latent_col_end]
+                    region_init_noise = init_noise[region.latent_slice]
                     region_latents = self.scheduler.add_noise(region.reference_latents, region_init_noise, timestep)
-                    latents[:, :, region.latent_row_init:region.latent_row_end, region.latent_col_init:region.latent_col_end] = region_latents
+                    latents[region.latent_slice] = region_latents
 
             if decode_steps:
                 steps_images.append(self.decode_latents(latents, cpu_vae))
@@ -3,7 +3,10 @@ from PIL import Image
 import pytest
 
 from mixdiff import Image2ImageRegion, StableDiffusionCanvasPipeline, Text2ImageRegion, preprocess_image
-from mixdiff.canvas import CanvasRegion
+from mixdiff.canvas import CanvasRegion, MaskWeightsBuilder, _batch_regions, _group_regions_by_shape, _inverse_contributors, _merge_noise_predictions
+from numpy import pi, exp, sqrt
+import numpy as np
+import torch
 
 ### CanvasRegion tests
 
@@ -23,6 +26,7 @@ def test_create_canvas_region_correct(region_params):
     assert region.col_end == region_params["col_end"]
     assert region.height == region.row_end - region.row_init
     assert region.width == region.col_end - region.col_init
+    assert region.latent_slice[2:] == (slice(region.row_init // 8, region.row_end // 8), slice(region.col_init // 8, region.col_end // 8))
 
 def test_create_canvas_region_eps():
     """Creating a correct canvas region works"""
@@ -96,6 +100,135 @@ def test_create_image2image_region_negative_strength(region_params, base_image):
     with pytest.raises(ValueError):
         Image2ImageRegion(**region_params, reference_image=base_image)
 
+### MaskWeightsBuilder tests
+
+@pytest.mark.parametrize("region_params", [
+    {"row_init": 0, "row_end": 512, "col_init": 0, "col_end": 512},
+    {"row_init": 0, "row_end": 256, "col_init": 64, "col_end": 576, "mask_weight": 0.5},
+])
+def test_gaussian_mask_weights(region_params):
+    """Gaussian mask weights follow the gaussian kernel over the region"""
+    region = Text2ImageRegion(**region_params, mask_type="gaussian")
+    latent_width = region.latent_col_end - region.latent_col_init
+    latent_height = region.latent_row_end - region.latent_row_init
+    var = 0.01
+    x_probs = [exp(-(x-(latent_width-1)/2)**2/(latent_width*latent_width)/(2*var)) / sqrt(2*pi*var) for x in range(latent_width)]
+    y_probs = [exp(-(y-(latent_height-1)/2)**2/(latent_height*latent_height)/(2*var)) / sqrt(2*pi*var) for y in range(latent_height)]
+    expected = np.outer(y_probs, x_probs) * region.mask_weight
+
+    weights = MaskWeightsBuilder().compute_mask_weights(region)
+    assert weights.shape == (1, 1, latent_height, latent_width)
+    assert torch.allclose(weights[0, 0], torch.tensor(expected, dtype=torch.float32))
+
+def test_quartic_mask_weights():
+    """Quartic mask weights follow the quartic kernel over the region"""
+    region = Text2ImageRegion(0, 256, 0, 512, mask_type="quartic", mask_weight=2.0)
+    support_x = np.arange(64) / 63 * 1.99 - 0.995
+    support_y = np.arange(32) / 31 * 1.99 - 0.995
+    expected = np.outer(15. / 16. * np.square(1 - np.square(support_y)), 15. / 16. * np.square(1 - np.square(support_x))) * region.mask_weight
+
+    weights = MaskWeightsBuilder().compute_mask_weights(region)
+    assert weights.shape == (1, 1, 32, 64)
+    assert torch.allclose(weights[0, 0], torch.tensor(expected, dtype=torch.float32))
+
+def test_mask_weights_cached():
+    """Regions with the same mask type, shape and weight share the same weights tensor"""
+    builder = MaskWeightsBuilder()
+    weights = builder.compute_mask_weights(Text2ImageRegion(0, 256, 0, 256, mask_type="quartic"))
+    assert builder.compute_mask_weights(Text2ImageRegion(256, 512, 128, 384, mask_type="quartic")) is weights
+    assert builder.compute_mask_weights(Text2ImageRegion(0, 256, 0, 256, mask_type="quartic", mask_weight=0.5)) is not weights
+    assert builder.compute_mask_weights(Text2ImageRegion(0, 256, 0, 256, mask_type="gaussian")) is not weights
+
+### Noise predictions merge tests
+
+def test_merge_noise_predictions():
+    """Merging noise predictions averages overlapping regions by their mask weights, and leaves uncovered positions as zeros"""
+    torch.manual_seed(0)
+    latents_shape = (1, 4, 8, 10)
+    # Two overlapping regions, and columns 8-9 not covered by any of them
+    regions = [Text2ImageRegion(0, 48, 0, 48, mask_type="gaussian"), Text2ImageRegion(16, 64, 16, 64, mask_type="quartic", mask_weight=0.5)]
+    builder = MaskWeightsBuilder()
+    masks = [builder.compute_mask_weights(region) for region in regions]
+    noise_preds = [torch.randn(1, 4, 6, 6) for _ in regions]
+
+    # Reference: accumulate each region contribution over its slice, then average
+    expected = torch.zeros(latents_shape)
+    contributors = torch.zeros(latents_shape)
+    for region, noise_pred, mask in zip(regions, noise_preds, masks):
+        expected[region.latent_slice] += noise_pred * mask
+        contributors[region.latent_slice] += mask
+    expected = torch.nan_to_num(expected / contributors)
+
+    noise_preds_padded = torch.zeros((len(regions), *latents_shape))
+    masks_padded = torch.zeros((len(regions), *latents_shape[-2:]))
+    for idx, (region, noise_pred, mask) in enumerate(zip(regions, noise_preds, masks)):
+        noise_preds_padded[idx][region.latent_slice] = noise_pred
+        masks_padded[idx][region.latent_slice[2:]] = mask[0, 0]
+    merged = _merge_noise_predictions(noise_preds_padded, masks_padded, _inverse_contributors(masks_padded))
+
+    assert merged.shape == latents_shape
+    assert not torch.isnan(merged).any()
+    assert torch.all(merged[..., 8:] == 0)
+    assert torch.allclose(merged, expected, atol=1e-6)
+
+### Region batching tests
+
+def test_group_regions_by_shape():
+    """Regions are grouped by their shape in latent space, keeping their original order"""
+    regions = [
+        Text2ImageRegion(0, 512, 0, 512),
+        Text2ImageRegion(0, 256, 0, 512),
+        Text2ImageRegion(256, 768, 256, 768),
+        Text2ImageRegion(256, 512, 128, 640),
+        Text2ImageRegion(0, 512, 0, 256),
+    ]
+    assert sorted(_group_regions_by_shape(regions)) == [[0, 2], [1, 3], [4]]
+
+def test_group_regions_by_shape_empty():
+    """Grouping no regions produces no groups"""
+    assert _group_regions_by_shape([]) == []
+
+@pytest.fixture()
+def batching_regions():
+    # Five regions of one shape (indices 0, 1, 3, 4, 6) and two of another one (indices 2, 5)
+    return [
+        Text2ImageRegion(0, 512, 0, 512),
+        Text2ImageRegion(0, 512, 256, 768),
+        Text2ImageRegion(0, 256, 0, 512),
+        Text2ImageRegion(256, 768, 0, 512),
+        Text2ImageRegion(256, 768, 256, 768),
+        Text2ImageRegion(256, 512, 0, 512),
+        Text2ImageRegion(512, 1024, 512, 1024),
+    ]
+
+def test_batch_regions_padding(batching_regions):
+    """With padding, incomplete batches of a shape spanning several batches are padded to a uniform size"""
+    batches = _batch_regions(batching_regions, regions_batch_size=2, pad=True)
+    assert sorted(batches) == sorted([
+        ([0, 1], [0, 1]),
+        ([3, 4], [3, 4]),
+        ([6], [6, 6]),
+        ([2, 5], [2, 5]),
+    ])
+
+def test_batch_regions_padding_discarded(batching_regions):
+    """Padded entries never appear in the indices of regions whose predictions are taken"""
+    batches = _batch_regions(batching_regions, regions_batch_size=3, pad=True)
+    taken = [idx for batch_indices, _ in batches for idx in batch_indices]
+    assert sorted(taken) == list(range(len(batching_regions)))
+    for batch_indices, batch_inputs in batches:
+        assert batch_inputs[:len(batch_indices)] == batch_indices
+
+@pytest.mark.parametrize("regions_batch_size, pad", [(2, False), (3, True), (None, True), (None, False)])
+def test_batch_regions_no_padding(batching_regions, regions_batch_size, pad):
+    """No padding takes place when disabled, when a shape fits in a single batch, or when batches are unbounded"""
+    batches = _batch_regions(batching_regions, regions_batch_size=regions_batch_size, pad=pad)
+    for batch_indices, batch_inputs in batches:
+        if not pad or 2 in batch_indices or regions_batch_size is None:
+            assert batch_inputs == batch_indices
+    if regions_batch_size is None:
+        assert sorted(batch_indices for batch_indices, _ in batches) == [[0, 1, 3, 4, 6], [2, 5]]
+
 ### StableDiffusionCanvasPipeline tests
 
 @pytest.fixture(scope="session")
@@ -122,12 +255,22 @@ def basic_canvas_params():
 @pytest.mark.parametrize("extra_canvas_params", [
     {"num_inference_steps": 1},
     {"num_inference_steps": 1, "cpu_vae": True},
+    {"num_inference_steps": 1, "regions_batch_size": 2},
+    {"num_inference_steps": 1, "regions_batch_size": None},
 ])
 def test_stable_diffusion_canvas_pipeline_correct(canvas_pipeline, basic_canvas_params, extra_canvas_params):
     """The StableDiffusionCanvasPipeline works for some correct configurations"""
     image = canvas_pipeline(**basic_canvas_params, **extra_canvas_params)["sample"][0]
     assert image.size == (64, 64)
 
+@pytest.mark.parametrize("regions_batch_size", [2, None])
+def test_stable_diffusion_canvas_pipeline_batched_regions(canvas_pipeline, basic_canvas_params, regions_batch_size):
+    """Diffusing several regions in the same U-net batch produces the same image as diffusing them one by one"""
+    image = canvas_pipeline(**basic_canvas_params, num_inference_steps=2, regions_batch_size=1)["sample"][0]
+    image_batched = canvas_pipeline(**basic_canvas_params, num_inference_steps=2, regions_batch_size=regions_batch_size)["sample"][0]
+    diff = np.abs(np.asarray(image, dtype=np.int16) - np.asarray(image_batched, dtype=np.int16))
+    assert diff.max() <= 2
+
 @pytest.mark.parametrize("extra_canvas_params", [
     {"num_inference_steps": 3},
     {"num_inference_steps": 3, "cpu_vae": True},